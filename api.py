@@ -3,15 +3,18 @@ import requests
 import pprint
 import json
 import logging
+import threading
 
 from pymongo import MongoClient
-from time import time
+from time import time, sleep
 from collections import deque
 
 
 class RateLimiter:
     '''
     As we have a limited number of API tokens, we want to call the API only if the rate limit is not being exceeded.  This class maintains a queue of call timestamps so that we can detect if we're going over a specified limit.
+
+    The caller and the prefetcher's thread share these, so every method holds lock.  To check for a token and take it in one step, hold lock around both.  Requests made by the prefetcher are also kept in bQueue, so the caller can tell when it's the prefetcher that used up the window.
     '''
     def __init__(self, requestLimit, timeLimit):
         '''
@@ -20,29 +23,328 @@ class RateLimiter:
         self.requestLimit = requestLimit
         self.timeLimit = timeLimit
         self.rQueue = deque()
+        self.bQueue = deque()
+        self.lastForeground = 0
+        self.lock = threading.RLock()
 
     def _clean_queue(self):
         '''
         Pops from the timestamp queue until everything further from the current time the imposed time limit is removed.  For internal use only.
         '''
-        t = time()
-        while len(self.rQueue) > 0 and self.rQueue[0] < t - self.timeLimit:
-            rQueue.popleft()
+        with self.lock:
+            t = time()
+            while len(self.rQueue) > 0 and self.rQueue[0] <= t - self.timeLimit:
+                self.rQueue.popleft()
+            while len(self.bQueue) > 0 and self.bQueue[0] <= t - self.timeLimit:
+                self.bQueue.popleft()
 
     def is_available(self):
         '''
         Availability check.  First clear everything from the queue that is older than the current window, then check to see if the number of requests we've seen in this window is smaller than the number of requests we're allowed.  
         '''
-        self._clean_queue()
-        return len(self.rQueue) < self.requestLimit
+        with self.lock:
+            self._clean_queue()
+            return len(self.rQueue) < self.requestLimit
+
+    def request(self, background = False):
+        with self.lock:
+            t = time()
+            self.rQueue.append(t)
+            if background:
+                self.bQueue.append(t)
+            else:
+                self.lastForeground = t
+
+    def remaining(self):
+        '''
+        Number of requests that can still be made in the current window.
+        '''
+        with self.lock:
+            self._clean_queue()
+            return max(self.requestLimit - len(self.rQueue), 0)
+
+    def background(self):
+        '''
+        Number of requests in the current window made by the prefetcher.
+        '''
+        with self.lock:
+            self._clean_queue()
+            return len(self.bQueue)
+
+    def idle_for(self):
+        '''
+        Seconds since the last request that wasn't made by the prefetcher.
+        '''
+        with self.lock:
+            return time() - self.lastForeground
+
+    def reset_in(self):
+        '''
+        Seconds until the oldest request in the window expires and frees up a 
+        token.  Zero if the queue is empty.
+        '''
+        with self.lock:
+            self._clean_queue()
+            if len(self.rQueue) == 0:
+                return 0
+            return max(self.rQueue[0] + self.timeLimit - time(), 0)
 
-    def request(self):
-        self.rQueue.append(time())
+
+class Prefetcher:
+    '''
+    After a matchlist is fetched, the next thing a caller usually does is ask 
+    for the most recent matches in it, each of which is a cold call to the 
+    external API.  This class watches matchlist fetches and player lookups 
+    and, on a background thread, fetches the likely next matches so that 
+    those reads are served from the DB instead.
+
+    The caller's requests come first.  The prefetcher only takes a token from 
+    the shortest rate limit window when the caller hasn't made a request for 
+    a whole window and more than half of the window will still be free 
+    afterwards.  If the caller then runs out of tokens because of the 
+    prefetcher, _call_API waits for one to free up rather than failing.  In 
+    the longer windows, the prefetcher is held to its own budget of longShare 
+    of the window.  Items that are already in the DB cost no tokens and are 
+    handled right away.  The amount of queued work is capped at maxPending.
+
+    The caller's get_match and get_matchlist claim an item before fetching 
+    it, which takes it off the queue or waits for a prefetch of it that is 
+    already running, so the same item is never fetched by both threads.
+    '''
+    def __init__(self, api, depth = 5, maxPending = 20, longShare = 0.1):
+        '''
+        api: the RiotAPI instance whose limits and DB the prefetcher shares
+        depth: number of most recent matches to prefetch per matchlist
+        maxPending: cap on queued work, counting a matchlist as the depth 
+        matches it will lead to plus itself
+        longShare: fraction of each longer window that prefetching may spend
+        '''
+        self.api = api
+        self.depth = depth
+        self.maxPending = maxPending
+        self.shortLimit = min(api.limits, key = lambda limit: limit.timeLimit)
+        self.longLimits = [limit for limit in api.limits if limit is not self.shortLimit]
+        self.budgets = [RateLimiter(max(int(limit.requestLimit * longShare), 1), limit.timeLimit) for limit in self.longLimits]
+        # matches are fetched before matchlists; a matchlist prefetched for a 
+        # looked-up player only produces more matches to fetch
+        self.matchQueue = deque()
+        self.matchlistQueue = deque()
+        self.queued = set()
+        # inflight: items being fetched right now, by either thread
+        # deferred: queued items known not to be in the DB, waiting for a 
+        # spare token, which is tried again at retryAt
+        self.inflight = set()
+        self.deferred = set()
+        self.retryAt = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch_players(self, player_info):
+        '''
+        Queues the matchlists of players returned by get_player_info.
+        '''
+        for player in player_info:
+            for name in player:
+                if name == '_id':
+                    continue
+                self._queue(self.matchlistQueue, ('matchlist', str(player[name]['info']['id'])), self.depth + 1)
+
+    def watch_matchlist(self, playerid, match_list):
+        '''
+        Queues the most recent matches of a matchlist returned by 
+        get_matchlist.
+        '''
+        if not match_list:
+            return
+        matches = match_list[playerid]['info'].get('matches', [])
+        matches = sorted(matches, key = lambda match: match.get('timestamp', 0), reverse = True)
+        for match in matches[:self.depth]:
+            self._queue(self.matchQueue, ('match', str(match['matchId'])), 1)
+
+    def claim(self, task):
+        '''
+        Called by the caller before fetching an item itself.  Waits for a 
+        prefetch of the item that is already running, then takes the item off 
+        the queue and marks it in flight until release is called.
+        '''
+        with self.condition:
+            while task in self.inflight:
+                self.condition.wait()
+            if task in self.queued:
+                self._dequeue(task)
+            self.inflight.add(task)
+
+    def release(self, task):
+        with self.condition:
+            self.inflight.discard(task)
+            self.condition.notify_all()
+
+    def stop(self):
+        '''
+        Stops the background thread, letting a fetch that is already running 
+        finish first.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _pending(self):
+        return len(self.matchQueue) + len(self.matchlistQueue) * (self.depth + 1)
+
+    def _queue(self, queue, task, cost):
+        with self.condition:
+            if task in self.queued or task in self.inflight:
+                return
+            if self._pending() + cost > self.maxPending:
+                return
+            self.queued.add(task)
+            queue.append(task)
+            self.condition.notify_all()
+
+    def _dequeue(self, task):
+        self.queued.discard(task)
+        self.deferred.discard(task)
+        queue = self.matchQueue if task[0] == 'match' else self.matchlistQueue
+        queue.remove(task)
+
+    def _finish(self, task):
+        with self.condition:
+            if task in self.queued:
+                self._dequeue(task)
+
+    def _next_task(self):
+        '''
+        Returns the next task to work on and whether it still has to be 
+        looked up in the DB, or (None, None) if there is nothing to do yet.  
+        Deferred tasks were already looked up, so once retryAt has passed they 
+        go straight to asking for a token.
+        '''
+        for queue in (self.matchQueue, self.matchlistQueue):
+            for task in queue:
+                if task not in self.deferred:
+                    return task, True
+        if self.deferred and time() >= self.retryAt:
+            for queue in (self.matchQueue, self.matchlistQueue):
+                for task in queue:
+                    if task in self.deferred:
+                        self.deferred.discard(task)
+                        return task, False
+        return None, None
+
+    def _idle_wait(self):
+        '''
+        Seconds to wait before a token can be spent on prefetching.  Zero if 
+        one can be spent now.
+        '''
+        waits = []
+        idle = self.shortLimit.idle_for()
+        if idle < self.shortLimit.timeLimit:
+            waits.append(self.shortLimit.timeLimit - idle)
+        if (self.shortLimit.remaining() - 1) * 2 <= self.shortLimit.requestLimit:
+            waits.append(self.shortLimit.reset_in())
+        for limit in self.longLimits + self.budgets:
+            if limit.remaining() == 0:
+                waits.append(limit.reset_in())
+        if not waits:
+            return 0
+        # never spin, even if a window is right at its boundary
+        return max(max(waits), 0.1)
+
+    def _reserve(self):
+        '''
+        Takes a token for a prefetch if one is spare.  The check and the 
+        request happen under the limiters' locks, so the caller can't take 
+        the same token in between.  Returns zero if a token was taken, 
+        otherwise the seconds to wait before trying again.
+        '''
+        self.api._lock_limits()
+        try:
+            wait = self._idle_wait()
+            if wait == 0:
+                for limit in self.api.limits:
+                    limit.request(background = True)
+                for budget in self.budgets:
+                    budget.request()
+            return wait
+        finally:
+            self.api._unlock_limits()
+
+    def _cached(self, task):
+        '''
+        Read-only version of _get_call_item_single: returns the DB entry for 
+        the item if there is one that isn't stale.  Stale entries are left for 
+        the fetch to replace.
+        '''
+        kind, item = task
+        db_collection = self.api.matches if kind == 'match' else self.api.playersMatches
+        db_item = db_collection.find_one( { item : {'$exists': True } } )
+        if db_item and time() - db_item[item]['lastUpdate'] < self.api.updateFrequency:
+            return db_item
+        return None
+
+    def _prefetch(self, task, lookup):
+        '''
+        Fetches a single item.  Returns zero once the item is dealt with, or 
+        the seconds to wait if it needs an API call and there is no spare 
+        token for it.
+        '''
+        kind, item = task
+        if lookup:
+            data = self._cached(task)
+            if data:
+                if kind == 'matchlist':
+                    self._finish(task)
+                    self.watch_matchlist(item, data)
+                return 0
+        wait = self._reserve()
+        if wait > 0:
+            return wait
+        if kind == 'match':
+            self.api._fetch_match(item, reserved = True)
+        else:
+            data = self.api._fetch_matchlist(item, reserved = True)
+            # take the matchlist off the queue first, so that its share of 
+            # maxPending is free for the matches it leads to
+            self._finish(task)
+            self.watch_matchlist(item, data)
+        return 0
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running:
+                        return
+                    task, lookup = self._next_task()
+                    if task:
+                        break
+                    if self.deferred:
+                        self.condition.wait(max(self.retryAt - time(), 0.01))
+                    else:
+                        self.condition.wait()
+                self.inflight.add(task)
+            wait = 0
+            try:
+                wait = self._prefetch(task, lookup)
+            except Exception:
+                logging.exception('Prefetch failed for ' + task[0] + ' ' + task[1])
+            with self.condition:
+                self.inflight.discard(task)
+                if wait > 0:
+                    self.deferred.add(task)
+                    self.retryAt = time() + wait
+                elif task in self.queued:
+                    self._dequeue(task)
+                self.condition.notify_all()
 
 
 class RiotAPI:
 
-    def __init__(self):
+    def __init__(self, prefetch = False, prefetchDepth = 5):
         '''
         Some parameters worth mentioning
 
@@ -51,6 +353,8 @@ class RiotAPI:
         playersCollection, playersMatches, matches: three collections (analogous to tables) with ireliaDB
         updateFrequency: time period to decide when stale data gets updated
         limits: instances of the RateLimiter class, which limit the number of API calls we can make
+        prefetcher: if prefetch is set, a Prefetcher that fetches the 
+        prefetchDepth most recent matches of players and matchlists we look up
         '''
         self.api_key = os.environ.get('RIOT_API_KEY')
         self.client = MongoClient()
@@ -60,9 +364,18 @@ class RiotAPI:
         self.matches = self.db.matches
         self.updateFrequency = 36000000
         self.limits = [RateLimiter(5,5), RateLimiter(250, 600)]
+        self.prefetcher = Prefetcher(self, prefetchDepth) if prefetch else None
 
         logging.basicConfig(filename = 'RiotAPI.log', level = logging.DEBUG)
 
+    def close(self):
+        '''
+        Stops the prefetcher's background thread, if there is one.
+        '''
+        if self.prefetcher:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
     def _base_query_multi(self, db_collection, url_left, url_right, items):
         '''
         Base query for our API, for the external API calls that allow 
@@ -105,6 +418,9 @@ class RiotAPI:
         url_variable = ','.join(call_items)
         if url_variable:
             r = self._call_API('https://na.api.pvp.net/api/lol/na' + url_left + url_variable + url_right)
+            # nothing is cached for a call that didn't go through
+            if r is None:
+                return data
             call_data = json.loads(r.content)
             t = time()
             for d in call_data:
@@ -115,7 +431,7 @@ class RiotAPI:
             db_collection.insert(dbUpdate)
         return data
 
-    def _base_query_single(self, db_collection, url_left, url_right, item):
+    def _base_query_single(self, db_collection, url_left, url_right, item, reserved = False):
         '''
         Base query for our API, for the external API calls that only allow a 
         single value
@@ -141,10 +457,17 @@ class RiotAPI:
         An item that the query wants to get, e.g. info about a match with a 
         given id.  Most calls to the external Riot API only permit a single 
         input; this function handles those cases.
+
+        reserved : bool
+
+        Whether a rate limit token was already taken for this call, see 
+        _call_API.
         '''
         call_item, data = self._get_call_item_single(db_collection, item)
         if call_item:
-            r = self._call_API('https://na.api.pvp.net/api/lol/na' + url_left + item + url_right)
+            r = self._call_API('https://na.api.pvp.net/api/lol/na' + url_left + item + url_right, reserved)
+            if r is None:
+                return None
             call_data = json.loads(r.content)
             t = time()
             x = {'info': call_data, 'lastUpdate': t}
@@ -266,16 +589,58 @@ class RiotAPI:
         return call_item, data
 
 
-    def _call_API(self, url):
+    def _lock_limits(self):
+        for limit in self.limits:
+            limit.lock.acquire()
+
+    def _unlock_limits(self):
+        for limit in reversed(self.limits):
+            limit.lock.release()
+
+    def _take_token(self):
         '''
-        Calls the API if we're not rate-limited.  
+        Checks every limiter for a token and takes it, all under the 
+        limiters' locks so the prefetcher can't take the same token in 
+        between.  Returns zero if a token was taken, None if we're 
+        rate-limited by our own requests, or the seconds to wait if it's only 
+        the prefetcher's requests that used up the window.
         '''
-        if all([limit.is_available for limit in self.limits]):
-            r = requests.get(url, params = {'api_key' : self.api_key})
-            for limit in self.limits:
-                limit.request()
-        else:
-            logging.warning('Rate limit exceeded for RiotAPI class.  Last call: ' + url)
+        self._lock_limits()
+        try:
+            blocked = [limit for limit in self.limits if not limit.is_available()]
+            if not blocked:
+                for limit in self.limits:
+                    limit.request()
+                return 0
+            # without the prefetcher's requests there'd have been a token
+            if all([limit.background() > 0 for limit in blocked]):
+                return max(max([limit.reset_in() for limit in blocked]), 0.01)
+            return None
+        finally:
+            self._unlock_limits()
+
+    def _call_API(self, url, reserved = False):
+        '''
+        Calls the API if we're not rate-limited.  Returns None if there is no 
+        token available or if the call fails (e.g. a 429 from Riot), so that 
+        the response doesn't get cached as if it were real data.
+
+        The caller's requests come before the prefetcher's, so if the 
+        prefetcher is why there's no token, this waits for one instead.  
+        reserved is set by the prefetcher, which takes its token beforehand.
+        '''
+        if not reserved:
+            wait = self._take_token()
+            while wait:
+                sleep(wait)
+                wait = self._take_token()
+            if wait is None:
+                logging.warning('Rate limit exceeded for RiotAPI class.  Last call: ' + url)
+                return None
+        r = requests.get(url, params = {'api_key' : self.api_key})
+        if r.status_code != 200:
+            logging.warning('RiotAPI call failed with status ' + str(r.status_code) + '.  Last call: ' + url)
+            return None
         return r
 
 
@@ -300,6 +665,12 @@ class RiotAPI:
         }
         ]
         '''
+        data = self._fetch_player_info(players)
+        if self.prefetcher:
+            self.prefetcher.watch_players(data)
+        return data
+
+    def _fetch_player_info(self, players):
         db_collection = self.playersCollection
         url_left = '/v1.4/summoner/by-name/'
         url_right = ''
@@ -332,23 +703,46 @@ class RiotAPI:
         '''
         Given a match id, returns a json object containing match info
         '''
+        if not self.prefetcher:
+            return self._fetch_match(matchid)
+        task = ('match', matchid)
+        self.prefetcher.claim(task)
+        try:
+            return self._fetch_match(matchid)
+        finally:
+            self.prefetcher.release(task)
+
+    def _fetch_match(self, matchid, reserved = False):
         db_collection = self.matches
         url_left = '/v2.2/match/'
         url_right = ''
-        return self._base_query_single(db_collection, url_left, url_right, matchid)
+        return self._base_query_single(db_collection, url_left, url_right, matchid, reserved)
 
     def get_matchlist(self, playerid):
         '''
         Given a player id, returns a json object containing all the matches 
         they've played
         '''
+        if not self.prefetcher:
+            return self._fetch_matchlist(playerid)
+        task = ('matchlist', playerid)
+        self.prefetcher.claim(task)
+        try:
+            data = self._fetch_matchlist(playerid)
+        finally:
+            self.prefetcher.release(task)
+        self.prefetcher.watch_matchlist(playerid, data)
+        return data
+
+    def _fetch_matchlist(self, playerid, reserved = False):
         db_collection = self.playersMatches
         url_left = '/v2.2/matchlist/by-summoner/'
         url_right = ''
-        return self._base_query_single(db_collection, url_left, url_right, playerid)
+        return self._base_query_single(db_collection, url_left, url_right, playerid, reserved)
 
     def get_matchlist_by_name(self, player):
-        player_info = self.get_player_info(player)
+        # the matchlist is fetched right below, so there's nothing to prefetch
+        player_info = self._fetch_player_info(player)
         return self.get_matchlist(str(player_info[0][player[0]]['info']['id']))
 
     def get_all_matches_by_name(self,player):
@@ -356,7 +750,7 @@ class RiotAPI:
         TODO: figure out rate throttling to make this work nicely with API 
         tokens
         '''
-        player_info = self.get_player_info([player])
+        player_info = self._fetch_player_info([player])
         player_id = player_info[0][player]['info']['id']
         match_list = self.get_matchlist(str(player_id))
         return [self.get_match(str(match['matchId'])) for match in match_list[str(player_id)]['info']['matches']]
\ No newline at end of file
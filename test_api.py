@@ -0,0 +1,163 @@
+import json
+import threading
+import unittest
+
+from time import time, sleep
+
+import api
+from api import RateLimiter, Prefetcher, RiotAPI
+
+
+class FakeCollection:
+    '''
+    In-memory stand-in for the parts of a MongoDB collection that RiotAPI
+    uses.
+    '''
+    def __init__(self):
+        self.docs = []
+        self.lock = threading.Lock()
+
+    def find_one(self, query):
+        key = list(query)[0]
+        with self.lock:
+            for doc in self.docs:
+                if key in doc:
+                    return doc
+        return None
+
+    def insert(self, docs):
+        with self.lock:
+            for doc in (docs if isinstance(docs, list) else [docs]):
+                doc['_id'] = len(self.docs) + 1
+                self.docs.append(doc)
+
+    def remove(self, query):
+        with self.lock:
+            self.docs = [doc for doc in self.docs if doc['_id'] != query['_id']]
+
+    def keys(self):
+        return [key for doc in self.docs for key in doc if key != '_id']
+
+
+class FakeDB:
+    def __init__(self):
+        self.playersCollection = FakeCollection()
+        self.playersMatches = FakeCollection()
+        self.matches = FakeCollection()
+
+
+class FakeClient:
+    def __init__(self):
+        self.ireliaDB = FakeDB()
+
+
+class FakeResponse:
+    def __init__(self, data, status_code = 200):
+        self.content = json.dumps(data)
+        self.status_code = status_code
+
+
+class PrefetcherTest(unittest.TestCase):
+    '''
+    Runs RiotAPI with a prefetcher against in-memory collections and a stub
+    for requests.get that records every url it's asked for.  Player names are
+    'p' followed by the player id, a player's matchlist has ten matches with
+    ids 100 * player id + i, and match i is the most recent.
+    '''
+    def setUp(self):
+        self.calls = []
+        self.callsLock = threading.Lock()
+        self.delay = 0.02
+        self.oldClient, self.oldGet = api.MongoClient, api.requests.get
+        api.MongoClient = FakeClient
+        api.requests.get = self.fake_get
+
+    def tearDown(self):
+        api.MongoClient, api.requests.get = self.oldClient, self.oldGet
+
+    def fake_get(self, url, params):
+        with self.callsLock:
+            self.calls.append((time(), url))
+        sleep(self.delay)
+        item = url.rsplit('/', 1)[1]
+        if 'by-name' in url:
+            return FakeResponse(dict((name, {'id': int(name[1:])}) for name in item.split(',')))
+        if 'matchlist' in url:
+            return FakeResponse({'matches': [{'matchId': int(item) * 100 + i, 'timestamp': i} for i in range(10)]})
+        return FakeResponse({'matchId': int(item)})
+
+    def make_api(self, limits, **kwargs):
+        x = RiotAPI()
+        x.limits = limits
+        x.prefetcher = Prefetcher(x, **kwargs)
+        self.addCleanup(x.close)
+        return x
+
+    def wait_for_prefetch(self, x, timeout = 5):
+        deadline = time() + timeout
+        while time() < deadline:
+            with x.prefetcher.condition:
+                if not x.prefetcher.queued and not x.prefetcher.inflight:
+                    return
+            sleep(0.01)
+        self.fail('prefetcher did not finish')
+
+    def urls(self, part):
+        return [url for t, url in self.calls if part in url]
+
+    def test_caller_requests_come_first(self):
+        x = self.make_api([RateLimiter(5, 0.5), RateLimiter(250, 600)], longShare = 1)
+        x.get_player_info(['p1'])
+        deadline = time() + 5
+        while x.limits[0].background() == 0 and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(x.limits[0].background() > 0)
+        # a full window of the caller's own requests, right after the
+        # prefetcher spent some tokens
+        results = [x.get_match(str(900 + i)) for i in range(5)]
+        self.assertTrue(all(results))
+        times = sorted(t for t, url in self.calls)
+        for i in range(len(times) - 5):
+            self.assertTrue(times[i + 5] - times[i] >= 0.45)
+
+    def test_prefetched_items_are_not_fetched_twice(self):
+        x = self.make_api([RateLimiter(100, 0.05), RateLimiter(1000, 600)], longShare = 1)
+        self.delay = 0.1
+        match_list = x.get_matchlist('1')
+        matches = sorted(match_list['1']['info']['matches'], key = lambda match: match['timestamp'], reverse = True)
+        # the window went idle during the slow matchlist call, so the
+        # prefetcher is now in the middle of fetching the most recent match
+        sleep(0.03)
+        self.assertTrue(('match', '109') in x.prefetcher.inflight)
+        for match in matches[:5]:
+            self.assertTrue(x.get_match(str(match['matchId'])))
+        self.wait_for_prefetch(x)
+        match_urls = self.urls('/match/')
+        self.assertEqual(len(match_urls), 5)
+        self.assertEqual(len(set(match_urls)), 5)
+        self.assertEqual(sorted(x.matches.keys()), sorted(set(x.matches.keys())))
+
+    def test_max_pending(self):
+        x = self.make_api([RateLimiter(1000, 0.2), RateLimiter(1000, 600)], depth = 5, maxPending = 20, longShare = 1)
+        x.get_player_info(['p' + str(i) for i in range(1, 41)])
+        # three matchlists fill 18 of the 20 pending
+        self.assertEqual(len(x.prefetcher.matchlistQueue), 3)
+        self.wait_for_prefetch(x)
+        self.assertEqual(len(self.urls('matchlist')), 3)
+        # each prefetched matchlist leads to all of its depth matches
+        self.assertEqual(len(self.urls('/match/')), 15)
+
+    def test_close_stops_thread(self):
+        x = self.make_api([RateLimiter(5, 5), RateLimiter(250, 600)])
+        thread = x.prefetcher.thread
+        # the prefetcher is waiting for the window to go idle
+        x.get_player_info(['p1'])
+        t = time()
+        x.close()
+        self.assertTrue(time() - t < 1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(x.prefetcher, None)
+
+
+if __name__ == '__main__':
+    unittest.main()